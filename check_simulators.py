@@ -0,0 +1,164 @@
+# This script checks that every simulator gives the same results as the
+# original day-by-day simulation, on random trials. InjectionSimulator and the
+# NumPy batch version are always checked, and the Numba and Cython versions
+# are checked if they are available. Run it after changing any of them with:
+#
+#     python check_simulators.py
+
+import sys
+import numpy as np
+import simulator
+from simulator import InjectionSimulator
+
+num_vials = 20
+vial_volume = 5.0
+num_trials = 500
+max_people = 4
+
+
+def original_simulation(doses, freqs):
+    """Runs one trial with the simulation as it was originally written,
+    simulating every day in turn. It is kept here, unoptimized, as the
+    reference the other simulators are checked against.
+
+    Input Arguments:
+    doses (list of floats): Each person's dosage, largest to smallest.
+    freqs (list of ints): The matching interval (days) between injections.
+
+    Returns:
+    waste (float): The amount of wasted medication.
+    day (int): How many days it took to use the allocated number of vials.
+    """
+    total_people = len(doses)
+    leftover_vial = False
+    leftover_amount = 0.0
+    vials_used = 0
+    waste = 0.0
+    left_in_vial = vial_volume
+
+    day = 1
+    while vials_used < num_vials:
+        injections_handled = [False]*total_people
+        while False in injections_handled:
+            for i in range(total_people):
+                if day % freqs[i] == 0 and injections_handled[i] == False:
+                    # Check the leftover vial first if there is one.
+                    dose = doses[i]
+                    if leftover_vial and (leftover_amount - dose >= 0):
+                        leftover_amount = leftover_amount - dose
+                        if leftover_amount - doses[-1] < 0:
+                            waste = waste + leftover_amount
+                            leftover_vial = False
+                        injections_handled[i] = True
+                    elif (left_in_vial - dose) >= 0:
+                        left_in_vial = left_in_vial - dose
+                        injections_handled[i] = True
+                else:
+                    injections_handled[i] = True
+
+            # Discard vial if there isn't enough for anyone, or keep it as the
+            # leftover vial if there is enough for some but not all people.
+            if left_in_vial < doses[-1]:
+                waste = waste + left_in_vial
+                vials_used = vials_used + 1
+                left_in_vial = vial_volume
+            elif left_in_vial < doses[0]:
+                leftover_vial = True
+                leftover_amount = left_in_vial
+                vials_used = vials_used + 1
+                left_in_vial = vial_volume
+        day = day + 1
+    return waste, day
+
+
+def random_trials(total_people, rng):
+    """Simulate random trials one at a time with original_simulation(), and
+    check InjectionSimulator against it.
+
+    Input Arguments:
+    total_people (int): The number of people in each trial.
+    rng (numpy.random.Generator): The source of random dosages.
+
+    Returns:
+    doses (2D array of floats): Each trial's dosages, largest to smallest.
+    freqs (2D array of ints): The matching injection intervals.
+    waste (array of floats): The amount of wasted medication per trial.
+    days (array of ints): How many days each trial took.
+    mismatches (int): How many trials InjectionSimulator got wrong.
+    """
+    names = ["person{}".format(i) for i in range(total_people)]
+    doses = np.empty((num_trials, total_people))
+    freqs = np.empty((num_trials, total_people), dtype=np.int32)
+    waste = np.empty(num_trials)
+    days = np.empty(num_trials, dtype=np.int32)
+    mismatches = 0
+    for p in range(num_trials):
+        dose_info = []
+        for i in range(total_people):
+            dose_info += [round(float(rng.uniform(0.02, 0.09)), 3),
+                          int(rng.integers(1, 9))]
+        trial = sorted(((round(dose_info[2*i]*dose_info[2*i + 1], 2),
+                         dose_info[2*i + 1]) for i in range(total_people)),
+                       key=lambda x: x[0], reverse=True)
+        doses[p] = [dose for dose, freq in trial]
+        freqs[p] = [freq for dose, freq in trial]
+        waste[p], days[p] = original_simulation(list(doses[p]),
+                                                list(freqs[p]))
+
+        result = InjectionSimulator(total_people, names, dose_info,
+                                    num_vials=num_vials,
+                                    vial_volume=vial_volume).run_simulation()
+        if (result[0] != waste[p] or result[1] != days[p]
+                or [d["dosage"] for d in result[2]] != list(doses[p])):
+            mismatches += 1
+    return doses, freqs, waste, days, mismatches
+
+
+def batch_simulators():
+    """Make a list of (name, function) for every available batch simulator,
+    each taking the same arguments as simulator.simulate_batch().
+    """
+    simulators = [("NumPy", simulator.simulate_batch_numpy)]
+    if simulator.NUMBA_AVAILABLE:
+        def simulate_batch_numba(doses, freqs, num_vials, vial_volume,
+                                 waste_cap):
+            return simulator.make_simulate_batch(doses.shape[1])(
+                doses, freqs, num_vials, vial_volume, waste_cap)
+        simulators.append(("Numba", simulate_batch_numba))
+    if simulator.simulate_batch_cython is not None:
+        simulators.append(("Cython", simulator.simulate_batch_cython))
+    return simulators
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    failures = 0
+    for total_people in range(1, max_people + 1):
+        doses, freqs, waste, days, mismatches = random_trials(total_people,
+                                                              rng)
+        print("{} people, InjectionSimulator: {} mismatches".format(
+            total_people, mismatches))
+        failures += mismatches
+
+        # With a waste cap, trials that stay within it must still match, and
+        # the rest must have been abandoned.
+        waste_cap = np.median(waste)
+        within_cap = waste <= waste_cap
+        for name, simulate_batch in batch_simulators():
+            batch_waste, batch_days = simulate_batch(
+                doses, freqs, num_vials, vial_volume, np.inf)
+            mismatches = np.count_nonzero((batch_waste != waste)
+                                          | (batch_days != days))
+
+            batch_waste, batch_days = simulate_batch(
+                doses, freqs, num_vials, vial_volume, waste_cap)
+            mismatches += np.count_nonzero(
+                np.where(within_cap,
+                         (batch_waste != waste) | (batch_days != days),
+                         batch_waste <= waste_cap))
+
+            print("{} people, {}: {} mismatches".format(
+                total_people, name, mismatches))
+            failures += mismatches
+
+    sys.exit(1 if failures > 0 else 0)
@@ -0,0 +1,233 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#
+# This is a Cython version of the simulator, for when Numba isn't available
+# or its compile time at startup matters. Build it once with:
+#
+#     python setup.py build_ext --inplace
+#
+# Once built, simulator.simulate_batch() uses it automatically whenever Numba
+# isn't installed.
+
+import numpy as np
+
+from libc.math cimport INFINITY
+
+
+cdef class CInjectionSimulator:
+    """CInjectionSimulator class runs the simulation of medication usage.
+
+    It works the same way as simulator.InjectionSimulator, but the dosages
+    and simulation state are typed, so the simulation runs as compiled C.
+
+    Methods:
+        __init__(self, total_people, namelist, dose_info, num_vials,
+                vial_volume)
+        check_legal_dosages()
+        do_injection(dose)
+        update_vials_used()
+        run_simulation(waste_cap)
+    """
+
+    cdef readonly int total_people
+    cdef readonly long long num_vials
+    cdef readonly double vial_volume
+    cdef readonly double max_dose, min_dose
+    cdef readonly list names
+    cdef readonly bint early_termination
+    cdef double[::1] doses
+    cdef long long[::1] freqs
+    cdef long long[::1] next_due
+    cdef unsigned char[::1] injections_handled
+    cdef int pending
+
+    # Simulation status variables.
+    cdef readonly bint leftover_vial
+    cdef readonly double leftover_amount
+    cdef readonly long long vials_used
+    cdef readonly double waste
+    cdef readonly double left_in_vial
+    cdef readonly long long day
+
+    def __init__(self, total_people, namelist, dose_info, num_vials=20,
+                 vial_volume=5.0):
+        """CInjectionSimulator Class Constructor to initialize the object and
+        determine the actual dosages instead of unit doses.
+
+        Input Arguments:
+        total_people (int): The number of people doing injections.
+        namelist (list of strings): The names of everyone in the simulation.
+        dose_info (array): The trial's permutation of each person's dosage.
+        num_vials (int): The number of medication vials to simulate
+        vial_volume (float): The volume of each medication vial.
+        """
+        # Convert the dose information into actual dosages, rounded the same
+        # way as simulator.InjectionSimulator.
+        doses = np.array([round(dose_info[0 + 2*i]*dose_info[1 + 2*i], 2)
+                          for i in range(total_people)], dtype=np.float64)
+
+        # Each row of dose_info holds one person's unit dose and frequency.
+        dose_info = np.asarray(dose_info, dtype=np.float64).reshape(
+            total_people, 2)
+
+        # Sort by largest to smallest dosage for compatibility.
+        order = np.argsort(-doses, kind="stable")
+        self.load(doses[order], dose_info[order, 1].astype(np.int64),
+                  num_vials, vial_volume)
+        self.names = [namelist[i] for i in order]
+        self.check_legal_dosages()
+
+    cdef void load(self, double[::1] doses, long long[::1] freqs,
+                   long long num_vials, double vial_volume):
+        """This method sets up the simulator for a trial's dosages, sorted
+        from largest to smallest.
+        """
+        if self.total_people != doses.shape[0]:
+            self.total_people = doses.shape[0]
+            self.next_due = np.empty(self.total_people, dtype=np.int64)
+            self.injections_handled = np.empty(self.total_people,
+                                               dtype=np.uint8)
+        self.doses = doses
+        self.freqs = freqs
+        self.num_vials = num_vials
+        self.vial_volume = vial_volume
+        self.max_dose = doses[0]
+        self.min_dose = doses[self.total_people - 1]
+
+    cpdef check_legal_dosages(self):
+        """This method tests edge cases and terminates the simulation if there
+        is an invalid condition.
+        """
+        # Make sure the largest dosage is not too large, and that there is
+        # not a negative dose.
+        self.early_termination = (self.max_dose > self.vial_volume
+                                  or self.min_dose <= 0)
+
+    cdef bint do_injection(self, double dose) noexcept:
+        """This method determines if there is enough medication left in the
+        vial to do the injection, then does the injection.
+
+        Returns True if the injection was a success, or False if there is not
+        enough medication to do the injection.
+        """
+        # Check the leftover vial first if there is one.
+        if self.leftover_vial and (self.leftover_amount - dose >= 0):
+            self.leftover_amount = self.leftover_amount - dose
+            if self.leftover_amount - self.min_dose < 0:
+                self.waste = self.waste + self.leftover_amount
+                self.leftover_vial = False
+            return True
+        elif (self.left_in_vial - dose) >= 0:
+            self.left_in_vial = self.left_in_vial - dose
+            return True
+        else:
+            return False
+
+    cdef void update_vials_used(self) noexcept:
+        """This method updates the number of vials used."""
+        # Discard vial if there isn't enough for anyone, then start a new one.
+        if self.left_in_vial < self.min_dose:
+            self.waste = self.waste + self.left_in_vial
+            self.vials_used = self.vials_used + 1
+            self.left_in_vial = self.vial_volume
+
+        # Create leftover vial if there is enough for some but not all people.
+        elif self.left_in_vial < self.max_dose:
+            self.leftover_vial = True
+            self.leftover_amount = self.left_in_vial
+            self.vials_used = self.vials_used + 1
+            self.left_in_vial = self.vial_volume
+
+    cdef void simulate(self, double waste_cap) noexcept:
+        """This method runs the simulation, skipping straight from one
+        injection day to the next, until the vials are used up or more than
+        waste_cap has been wasted.
+        """
+        cdef int i
+        self.leftover_vial = False
+        self.leftover_amount = 0.0
+        self.vials_used = 0
+        self.waste = 0.0
+        self.left_in_vial = self.vial_volume
+        for i in range(self.total_people):
+            self.next_due[i] = self.freqs[i]
+
+        self.day = 0
+        while self.vials_used < self.num_vials and self.waste <= waste_cap:
+            self.day = self.next_due[0]
+            for i in range(1, self.total_people):
+                if self.next_due[i] < self.day:
+                    self.day = self.next_due[i]
+
+            # If someone isn't due for an injection today, then treat their
+            # injection as handled for today.
+            self.pending = 0
+            for i in range(self.total_people):
+                self.injections_handled[i] = self.next_due[i] != self.day
+                if not self.injections_handled[i]:
+                    self.pending = self.pending + 1
+            while self.pending > 0:
+                for i in range(self.total_people):
+                    if (not self.injections_handled[i]
+                            and self.do_injection(self.doses[i])):
+                        self.injections_handled[i] = True
+                        self.pending = self.pending - 1
+                self.update_vials_used()
+
+            for i in range(self.total_people):
+                if self.next_due[i] == self.day:
+                    self.next_due[i] = self.next_due[i] + self.freqs[i]
+
+        # The simulation ends on the day after the last vial is used.
+        self.day = self.day + 1
+
+    def run_simulation(self, double waste_cap=INFINITY):
+        """This method runs the simulation.
+
+        Input arguments:
+        waste_cap (float): Abandon the trial as soon as it has wasted more
+        than this much medication.
+
+        Returns a list with the following information:
+        waste (float): The amount of wasted medication.
+        day (int): How many days it took to use the allocated number of vials.
+        dosage_dicts (list of dicts): The dosage info and name of each person.
+
+        Returns None if the dosages are invalid or the trial was abandoned.
+        """
+        if self.early_termination:
+            return None
+        self.simulate(waste_cap)
+        if self.waste > waste_cap:
+            return None
+        dosage_dicts = [{"dosage": self.doses[i], "frequency": self.freqs[i],
+                         "name": self.names[i]}
+                        for i in range(self.total_people)]
+        return [self.waste, self.day, dosage_dicts]
+
+
+def simulate_batch(doses, freqs, num_vials=20, vial_volume=5.0,
+                   waste_cap=INFINITY):
+    """Runs the simulation for many trials, one after another.
+
+    Takes the same arguments and returns the same results as
+    simulator.simulate_batch_numpy().
+    """
+    cdef double[:, ::1] dose_rows = np.ascontiguousarray(doses,
+                                                         dtype=np.float64)
+    cdef long long[:, ::1] freq_rows = np.ascontiguousarray(freqs,
+                                                            dtype=np.int64)
+    cdef Py_ssize_t p, total_trials = dose_rows.shape[0]
+    cdef double cap = waste_cap
+    waste = np.empty(total_trials)
+    days = np.empty(total_trials, dtype=np.int32)
+    cdef double[::1] trial_waste = waste
+    cdef int[::1] trial_days = days
+
+    cdef CInjectionSimulator trial = CInjectionSimulator.__new__(
+        CInjectionSimulator)
+    for p in range(total_trials):
+        trial.load(dose_rows[p], freq_rows[p], num_vials, vial_volume)
+        trial.simulate(cap)
+        trial_waste[p] = trial.waste
+        trial_days[p] = trial.day
+    return waste, days
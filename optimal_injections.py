@@ -16,8 +16,10 @@
 # displays the most optimal outcomes.
 
 import numpy as np
-import itertools
-from simulator import InjectionSimulator
+import heapq
+import multiprocessing
+import os
+from simulator import NUMBA_AVAILABLE, simulate_batch
 
 '''User-specified parameters:
 
@@ -27,6 +29,12 @@ step (float): The amount to increment daily dosage through different trials
 of the simulation. The default is 0.001. More precision than this is unlikely
 to show any additional unique results.
 num_outcomes (int): How many outcomes to print at the conclusion of simulation.
+ncpus (int): Without Numba, the number of worker processes used to run
+batches of trials in parallel. The default is every CPU on the machine. With
+Numba, batches are run one at a time and each is spread across threads
+instead; set the NUMBA_NUM_THREADS environment variable to limit them.
+batch_size (int): The number of trials simulated at once, by a worker
+process or, with Numba, by Numba's threads.
 people (list): This list becomes populated with the information for each
 person.
 person1, person2, ... (dicts): A dict that contains the person's:
@@ -40,6 +48,8 @@ num_vials = 20
 vial_volume = 5.0   # mL
 step = 0.001
 num_outcomes = 5
+ncpus = os.cpu_count()
+batch_size = 4096
 
 # Create a dict for each person and add them to the list of people.
 people = []
@@ -64,61 +74,224 @@ person3 = {
 }
 people.append(person3)
 
-# Make a list of arrays, each containing every value of dose_unit and dose_freq
-# per person, so that we can iterate our for loop over every permutation.
+# Make a list of everyone's names, in the order they were listed.
 total_people = len(people)
-iter_list = []
 name_list = []
 for idx in range(total_people):
-    iter_list.append(people[idx]["dose_unit"])
-    iter_list.append(people[idx]["dose_freq"])
     name_list.append(people[idx]["name"])
 
-# Iterate over every dosage permutation.
-result_list = []
-early_terminations = 0
-for dose_info in itertools.product(*iter_list):
-    trial = InjectionSimulator(total_people, name_list, dose_info,
-                            num_vials=num_vials, vial_volume=vial_volume)
-    trial_result = trial.run_simulation()
-
-    # Keep only unique outcomes.
-    if (trial_result not in result_list) and (trial_result != None):
-        result_list.append(trial_result)
-    elif trial_result == None:
-        early_terminations += 1
-
-if early_terminations > 0:
-    print("{} trials were aborted.".format(early_terminations))
-    print("This is likely a result of having a dose larger than the vial",
-           "volume or a negative dose.", "\n")
-
-# If all trials were aborted, then end the program.
-if result_list == []:
-    raise ValueError("There is no trial data due to early terminations.")
-
-# Do not print in scientific notation.
-np.set_printoptions(suppress=True)
-
-# Sort the results by the amount of medication wasted.
-result_list = sorted(result_list, key=lambda x: x[0])
-
-# Print the results.
-print("The least wasteful dosage schedules are:")
-for i in range(num_outcomes):
-    print("Optimal outcome:", i+1)
-    print("Total wasted medicine: ", f"{result_list[i][0]:.2f}", " mL")
-    print("In {} days, you will have used {} vials".format(
-        result_list[i][1], num_vials))
+# Work out every dosage each person could take, rounding each only once. A
+# dose larger than the vial volume or a negative dose would abort any trial
+# it is part of, so those are left out of the sweep altogether.
+person_doses = []
+person_freqs = []
+all_trials = 1
+for idx in range(total_people):
+    dosages = np.array([round(unit*freq, 2)
+                        for unit in people[idx]["dose_unit"]
+                        for freq in people[idx]["dose_freq"]],
+                       dtype=np.float64)
+    freqs = np.array([freq
+                      for unit in people[idx]["dose_unit"]
+                      for freq in people[idx]["dose_freq"]], dtype=np.int32)
+    legal = (dosages > 0) & (dosages <= vial_volume)
+    person_doses.append(dosages[legal])
+    person_freqs.append(freqs[legal])
+    all_trials *= len(dosages)
+
+# Every dosage permutation is numbered by its position in this grid of
+# everyone's choices. Each person's dose_unit varies slowest and the last
+# person's dose_freq fastest.
+sweep_shape = tuple(len(d) for d in person_doses)
+total_trials = int(np.prod(sweep_shape))
+early_terminations = all_trials - total_trials
+
+
+def init_worker(shared_waste_cap):
+    """Give a worker process, or this process with Numba, access to the
+    shared waste cap.
+
+    Input Arguments:
+    shared_waste_cap (multiprocessing.Value): The most medication a trial
+    can waste and still be one of the best outcomes found so far.
+    """
+    global waste_cap
+    waste_cap = shared_waste_cap
+
+
+def run_batch(trials):
+    """Run the simulation for a batch of dosage permutations.
+
+    Without Numba, this is executed in a worker process, so it relies on the
+    module-level parameters rather than having them pickled along with every
+    batch. The batch only names which permutations to simulate, and they are
+    built here. With Numba, it runs in the main process and the simulation
+    of the batch is spread across Numba's threads.
+
+    Input Arguments:
+    trials (range): The numbers of the permutations to simulate.
+
+    Returns a tuple with the following information:
+    repeated_trials (int): How many trials repeated the dosages of another
+    trial in the batch and weren't simulated again.
+    order (2D array of ints): For each trial that finished within the waste
+    cap and is among the batch's num_outcomes best unique outcomes, which
+    person (index into name_list) has each dosage.
+    doses (2D array of floats): Those trials' dosages, largest to smallest.
+    freqs (2D array of ints): Those trials' matching injection intervals.
+    waste (array of floats): The amount of wasted medication per trial.
+    days (array of ints): How many days each trial took.
+    """
+    choices = np.unravel_index(np.arange(trials.start, trials.stop),
+                               sweep_shape)
+    doses = np.column_stack([person_doses[i][choices[i]]
+                             for i in range(total_people)])
+    freqs = np.column_stack([person_freqs[i][choices[i]]
+                             for i in range(total_people)])
+
+    # Sort each trial by largest to smallest dosage for compatibility.
+    order = np.argsort(-doses, axis=1, kind="stable")
+    doses = np.take_along_axis(doses, order, axis=1)
+    freqs = np.take_along_axis(freqs, order, axis=1)
+
+    # Trials with the same dosages and frequencies have the same outcome, even
+    # if the dosages belong to different people, so only simulate each once.
+    unique_trials, trial_idx = np.unique(np.hstack((doses, freqs)), axis=0,
+                                         return_inverse=True)
+    trial_idx = trial_idx.reshape(-1)
+    repeated_trials = len(doses) - len(unique_trials)
+
+    cap = waste_cap.value
+    waste, days = simulate_batch(
+        unique_trials[:, :total_people],
+        unique_trials[:, total_people:].astype(np.int32),
+        num_vials=num_vials, vial_volume=vial_volume, waste_cap=cap)
+    waste, days = waste[trial_idx], days[trial_idx]
+
+    # Trials over the waste cap were abandoned, so don't send them back.
+    finished = waste <= cap
+
+    # Only the num_outcomes least wasteful unique outcomes in this batch can
+    # be among the best overall, so don't send back any that waste more.
+    _, unique_idx = np.unique(np.hstack((order, doses, freqs))[finished],
+                              axis=0, return_index=True)
+    if len(unique_idx) > num_outcomes:
+        unique_waste = waste[finished][unique_idx]
+        finished &= waste <= np.partition(unique_waste, num_outcomes - 1)[
+            num_outcomes - 1]
+    return (repeated_trials, order[finished],
+            doses[finished], freqs[finished], waste[finished], days[finished])
+
+
+def run_batches(batches, shared_waste_cap):
+    """Run every batch of trials, yielding each batch's results in order.
+
+    With Numba, each batch is already spread across threads, so the batches
+    are run in this process. Otherwise they are spread across ncpus worker
+    processes.
+
+    Input Arguments:
+    batches (iterable of ranges): The batches of trials to simulate.
+    shared_waste_cap (multiprocessing.Value): The most medication a trial
+    can waste and still be one of the best outcomes found so far.
+
+    Yields the results of run_batch() for each batch.
+    """
+    if NUMBA_AVAILABLE:
+        init_worker(shared_waste_cap)
+        yield from map(run_batch, batches)
+    else:
+        with multiprocessing.Pool(ncpus, initializer=init_worker,
+                                  initargs=(shared_waste_cap,)) as pool:
+            yield from pool.imap(run_batch, batches)
+
+
+if __name__ == "__main__":
+    # Each batch of trials is independent, so they can be run in parallel.
+    # Batches are built as they are run, so memory use doesn't grow with the
+    # size of the sweep.
+    batches = (range(start, min(start + batch_size, total_trials))
+               for start in range(0, total_trials, batch_size))
+
+    # Only the num_outcomes best unique outcomes so far are kept, in a heap
+    # with the worst of them on top. Entries are (-waste, -number, key,
+    # result), where number counts unique outcomes so ties go to the earliest
+    # one. Once the heap is full, any trial that wastes more than its worst
+    # outcome can't be one of the best, so the simulators are told to abandon
+    # those trials early.
+    #
+    # Only the keys of outcomes in the heap are remembered. A repeat of an
+    # outcome that was pushed out wastes just as much and comes later, so it
+    # would be pushed straight back out anyway.
+    shared_waste_cap = multiprocessing.Value("d", np.inf, lock=False)
+    best_results = []
+    seen_results = set()
+    outcome_number = 0
+    repeated_trials = 0
+    for (batch_repeats, order, doses, freqs, waste,
+         days) in run_batches(batches, shared_waste_cap):
+        repeated_trials += batch_repeats
+
+        # Keep only unique outcomes, keyed on the waste, days and dosages.
+        for p in range(len(waste)):
+            if waste[p] > shared_waste_cap.value:
+                continue
+            dosage_dicts = [{"dosage": doses[p, i],
+                             "frequency": freqs[p, i],
+                             "name": name_list[order[p, i]]}
+                            for i in range(total_people)]
+            key = (round(waste[p], 6), days[p],
+                   tuple((d["name"], d["dosage"], d["frequency"])
+                         for d in dosage_dicts))
+            if key in seen_results:
+                continue
+            outcome_number += 1
+            entry = (-waste[p], -outcome_number, key,
+                     [waste[p], days[p], dosage_dicts])
+            if len(best_results) < num_outcomes:
+                heapq.heappush(best_results, entry)
+            elif entry > best_results[0]:
+                dropped = heapq.heapreplace(best_results, entry)
+                seen_results.discard(dropped[2])
+            else:
+                continue
+            seen_results.add(key)
+        if len(best_results) == num_outcomes:
+            shared_waste_cap.value = -best_results[0][0]
+
+    if repeated_trials > 0:
+        print("{} of {} trials ({:.0%}) repeated the dosages of".format(
+            repeated_trials, total_trials, repeated_trials/total_trials),
+            "another trial and were only simulated once.", "\n")
+
+    if early_terminations > 0:
+        print("{} trials were aborted.".format(early_terminations))
+        print("This is likely a result of having a dose larger than the vial",
+               "volume or a negative dose.", "\n")
+
+    # If all trials were aborted, then end the program.
+    if not best_results:
+        raise ValueError("There is no trial data due to early terminations.")
+
+    # Do not print in scientific notation.
+    np.set_printoptions(suppress=True)
+
+    # Sort the results by the amount of medication wasted.
+    result_list = [entry[3] for entry in sorted(best_results, reverse=True)]
+
+    # Print the results.
+    print("The least wasteful dosage schedules are:")
+    for i in range(len(result_list)):
+        print("Optimal outcome:", i+1)
+        print("Total wasted medicine: ", f"{result_list[i][0]:.2f}", " mL")
+        print("In {} days, you will have used {} vials".format(
+            result_list[i][1], num_vials))
     
-    # Print dosage info for each person in the original order
-    print_info = result_list[i][2]
-    for j in range(total_people):
-        for k in range(total_people):
-            # Find the index that matches the original order
-            if print_info[k]["name"] == name_list[j]:
-                idx = k
-        print("{}'s dosage: {:.2f} mL every {} days".format(
-            print_info[idx]["name"], print_info[idx]["dosage"],
-            print_info[idx]["frequency"]))
-    print("")
\ No newline at end of file
+        # Print dosage info for each person in the original order
+        print_info = result_list[i][2]
+        idx_by_name = {d["name"]: idx for idx, d in enumerate(print_info)}
+        for name in name_list:
+            info = print_info[idx_by_name[name]]
+            print("{}'s dosage: {:.2f} mL every {} days".format(
+                info["name"], info["dosage"], info["frequency"]))
+        print("")
@@ -0,0 +1,9 @@
+# This script builds the optional Cython version of the simulator in place,
+# next to simulator.py. Run it once with:
+#
+#     python setup.py build_ext --inplace
+
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(ext_modules=cythonize("csimulator.pyx"))
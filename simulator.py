@@ -1,12 +1,41 @@
+from functools import lru_cache
+from operator import itemgetter
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # Numba is optional. Without it, simulate() runs as plain Python.
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    # The Cython version of the simulator, if it has been built by setup.py.
+    from csimulator import simulate_batch as simulate_batch_cython
+except ImportError:
+    simulate_batch_cython = None
+
+
 class InjectionSimulator(object):
     """InjectionSimulator class runs the simulation of medication usage.
     
+    The simulation itself is done by simulate(). This class determines the
+    dosages for a trial and keeps track of who they belong to.
+
     Methods:
         __init__(self, total_people, namelist, dose_info, num_vials,
                 vial_volume)
         check_legal_dosages()
-        do_injections(dose)
-        update_vials_used()
         run_simulation()
     """
 
@@ -27,27 +56,20 @@ class InjectionSimulator(object):
         self.num_vials = num_vials
         self.vial_volume = vial_volume
 
-        # Convert the dose information into actual dosages and store in a list.
-        self.dosage_dicts = []
-        for i in range(total_people):
-            info = {
-                "dosage": round(dose_info[0 + 2*i]*dose_info[1 + 2*i], 2),
-                "frequency": dose_info[1 + 2*i],
-                "name": namelist[i]
-                }
-            self.dosage_dicts.append(info)
-
-        # Sort dosage_dicts by largest to smallest dosage for compatibility.
-        self.dosage_dicts = sorted(self.dosage_dicts,
-                                   key=lambda x: x["dosage"], reverse=True)
-          
-        # Initialize simulation status variables.
-        self.injections_handled = [False]*self.total_people
-        self.leftover_vial = False
-        self.leftover_amount = 0.0
-        self.vials_used = 0
-        self.waste = 0.0
-        self.left_in_vial = vial_volume
+        # Convert the dose information into actual dosages. dose_info holds
+        # each person's unit dose and frequency in turn. Each dosage is
+        # rounded with round() on the values as given, since np.round()
+        # rounds some of them differently.
+        freqs = dose_info[1:2*total_people:2]
+        doses = [round(unit*freq, 2)
+                 for unit, freq in zip(dose_info[0::2], freqs)]
+
+        # Sort by largest to smallest dosage for compatibility, then store
+        # the dosages, frequencies and names as parallel tuples.
+        self.doses, self.freqs, self.names = zip(*sorted(
+            zip(doses, freqs, namelist), key=itemgetter(0), reverse=True))
+        self.max_dose = self.doses[0]
+        self.min_dose = self.doses[-1]
         self.check_legal_dosages()
 
     def check_legal_dosages(self):
@@ -56,81 +78,444 @@ class InjectionSimulator(object):
         """
         # Make sure the largest dosage is not too large.
         self.early_termination = False
-        if self.dosage_dicts[0]["dosage"] > self.vial_volume:
+        if self.max_dose > self.vial_volume:
             self.early_termination = True
 
         # Make sure there is not a negative dose.
-        if self.dosage_dicts[-1]["dosage"] <= 0:
+        if self.min_dose <= 0:
             self.early_termination = True
     
-    def do_injection(self, dose):
-        """This method determines if there is enough medication left in the
-        vial to do the injection, then does the injection.
+    def run_simulation(self, waste_cap=np.inf):
+        """This method runs the simulation.
 
         Input arguments:
-        dose (float): the dose of the current person's injection.
-
-        Returns:
-        True: if injection was a success.
-        False: if there is not enough medication to do the injection.        
-        """
-
-        # Check the leftover vial first if there is one.
-        if self.leftover_vial and (self.leftover_amount - dose >= 0):
-            self.leftover_amount = self.leftover_amount - dose
-            if (self.leftover_amount - self.dosage_dicts[-1]["dosage"] < 0):
-                self.waste = self.waste + self.leftover_amount
-                self.leftover_vial = False
-            return True
-        elif (self.left_in_vial - dose) >= 0:
-            self.left_in_vial = self.left_in_vial - dose
-            return True
-        else:
-            return False
-                
-    def update_vials_used(self):
-        """This method updates the number of vials used."""
-
-        # Discard vial if there isn't enough for anyone, then start a new one.
-        if self.left_in_vial < self.dosage_dicts[-1]["dosage"]:
-            self.waste = self.waste + self.left_in_vial
-            self.vials_used = self.vials_used + 1
-            self.left_in_vial = self.vial_volume
-
-        # Create leftover vial if there is enough for some but not all people.    
-        elif (self.left_in_vial >= self.dosage_dicts[-1]["dosage"]
-              and self.left_in_vial < self.dosage_dicts[0]["dosage"]):
-            self.leftover_vial = True
-            self.leftover_amount = self.left_in_vial
-            self.vials_used = self.vials_used + 1
-            self.left_in_vial = self.vial_volume
-                
-    def run_simulation(self):
-        """This method runs the simulation.
+        waste_cap (float): Abandon the trial as soon as it has wasted more
+        than this much medication, e.g. once it can no longer beat the best
+        outcomes found so far.
         
         Returns a list with the following information:
         waste (float): The amount of wasted medication.
         day (int): How many days it took to use the allocated number of vials.
         dosage_dicts (list of dicts): The dosage info and name of each person.
+
+        Returns None if the dosages are invalid or the trial was abandoned.
         """
         if self.early_termination:
             return None
-        self.day = 1
-        while self.vials_used < self.num_vials:
-            self.injections_handled = [False]*self.total_people
-            while False in self.injections_handled:
-                for i in range(self.total_people):
-                    # If someone is due for an injection today, and they
-                    # haven't done it yet, then do the injection.
-                    if (self.day % self.dosage_dicts[i]["frequency"] == 0 and
-                        self.injections_handled[i] == False):
-                        self.injections_handled[i] = self.do_injection(
-                            dose = self.dosage_dicts[i]["dosage"])
-                    else:
-                        # If they aren't due for an injection today, then
-                        # treat their injection as handled for today.
-                        self.injections_handled[i] = True
-                self.update_vials_used()
-            self.day = self.day + 1
-            
-        return [self.waste, self.day, self.dosage_dicts]
\ No newline at end of file
+        # Only uncapped runs are cached, since a capped run's outcome depends
+        # on the cap.
+        if waste_cap == np.inf:
+            self.waste, self.day = simulate_cached(
+                self.doses, self.freqs, self.num_vials, self.vial_volume)
+        else:
+            self.waste, self.day = simulate(
+                np.array(self.doses, dtype=np.float64),
+                np.array(self.freqs, dtype=np.int64), self.num_vials,
+                self.vial_volume, waste_cap)
+        if self.waste > waste_cap:
+            return None
+        dosage_dicts = [{"dosage": dose, "frequency": freq, "name": name}
+                        for dose, freq, name in zip(self.doses, self.freqs,
+                                                    self.names)]
+        return [self.waste, self.day, dosage_dicts]
+
+
+@njit(cache=True)
+def simulate(doses, freqs, num_vials, vial_volume, waste_cap):
+    """Runs the simulation for a single trial.
+
+    With Numba, it is compiled the first time it is used and cached on disk.
+
+    Input Arguments:
+    doses (array of floats): Each person's dosage, sorted from largest to
+    smallest.
+    freqs (array of ints): The matching interval (days) between injections.
+    num_vials (int): The number of medication vials to simulate.
+    vial_volume (float): The volume of each medication vial.
+    waste_cap (float): Stop early once more than this much medication has
+    been wasted.
+
+    The dosages must be legal (see check_legal_dosages), otherwise the
+    simulation never finishes.
+
+    Returns:
+    waste (float): The amount of wasted medication. If it is more than
+    waste_cap, the trial was stopped early.
+    day (int): How many days it took to use the allocated number of vials.
+    """
+    total_people = len(doses)
+    max_dose = doses[0]
+    min_dose = doses[-1]
+
+    # Initialize simulation status variables.
+    injections_handled = np.zeros(total_people, dtype=np.bool_)
+    leftover_vial = False
+    leftover_amount = 0.0
+    vials_used = 0
+    waste = 0.0
+    left_in_vial = vial_volume
+
+    # Nothing happens on days when nobody is due for an injection, so skip
+    # straight from one injection day to the next.
+    next_due = freqs.copy()
+    day = 0
+    while vials_used < num_vials and waste <= waste_cap:
+        day = next_due.min()
+
+        # If someone isn't due for an injection today, then treat their
+        # injection as handled for today.
+        injections_handled[:] = next_due != day
+        pending = total_people - np.count_nonzero(injections_handled)
+        while pending > 0:
+            for i in range(total_people):
+                # If someone is due for an injection today, and they haven't
+                # done it yet, then do the injection if there is enough
+                # medication left. Check the leftover vial first if there
+                # is one.
+                if not injections_handled[i]:
+                    dose = doses[i]
+                    if leftover_vial and (leftover_amount - dose >= 0):
+                        leftover_amount = leftover_amount - dose
+                        if leftover_amount - min_dose < 0:
+                            waste = waste + leftover_amount
+                            leftover_vial = False
+                        injections_handled[i] = True
+                        pending = pending - 1
+                    elif (left_in_vial - dose) >= 0:
+                        left_in_vial = left_in_vial - dose
+                        injections_handled[i] = True
+                        pending = pending - 1
+
+            # Discard vial if there isn't enough for anyone, then start a new
+            # one.
+            if left_in_vial < min_dose:
+                waste = waste + left_in_vial
+                vials_used = vials_used + 1
+                left_in_vial = vial_volume
+
+            # Create leftover vial if there is enough for some but not all
+            # people.
+            elif left_in_vial < max_dose:
+                leftover_vial = True
+                leftover_amount = left_in_vial
+                vials_used = vials_used + 1
+                left_in_vial = vial_volume
+
+        for i in range(total_people):
+            if next_due[i] == day:
+                next_due[i] = next_due[i] + freqs[i]
+
+    # The simulation ends on the day after the last vial is used.
+    return waste, day + 1
+
+
+# Templates for make_simulate() and make_simulate_batch(). Each person's
+# part of the simulation is written out separately, with {i} replaced by
+# their index. The generated module is given njit and prange by
+# _specialized_module() rather than importing them.
+_SPECIALIZED_HEADER = """# Generated by simulator.py for {total_people} people.
+
+import numpy as np
+
+
+@njit(cache=True)
+def simulate(doses, freqs, num_vials, vial_volume, waste_cap):
+    {unpack_doses} = doses
+    {unpack_freqs} = freqs
+    max_dose = dose_0
+    min_dose = dose_{last}
+    leftover_vial = False
+    leftover_amount = 0.0
+    vials_used = 0
+    waste = 0.0
+    left_in_vial = vial_volume
+    {unpack_next_due} = {unpack_freqs}
+    day = 0
+    while vials_used < num_vials and waste <= waste_cap:
+        day = {earliest_due}
+        pending = 0
+"""
+_SPECIALIZED_DUE = """
+        handled_{i} = next_due_{i} != day
+        if not handled_{i}:
+            pending = pending + 1
+"""
+_SPECIALIZED_PASS = """
+        while pending > 0:
+"""
+_SPECIALIZED_INJECTION = """
+            if not handled_{i}:
+                if leftover_vial and (leftover_amount - dose_{i} >= 0):
+                    leftover_amount = leftover_amount - dose_{i}
+                    if leftover_amount - min_dose < 0:
+                        waste = waste + leftover_amount
+                        leftover_vial = False
+                    handled_{i} = True
+                    pending = pending - 1
+                elif (left_in_vial - dose_{i}) >= 0:
+                    left_in_vial = left_in_vial - dose_{i}
+                    handled_{i} = True
+                    pending = pending - 1
+"""
+_SPECIALIZED_NEW_VIAL = """
+            if left_in_vial < min_dose:
+                waste = waste + left_in_vial
+                vials_used = vials_used + 1
+                left_in_vial = vial_volume
+            elif left_in_vial < max_dose:
+                leftover_vial = True
+                leftover_amount = left_in_vial
+                vials_used = vials_used + 1
+                left_in_vial = vial_volume
+"""
+_SPECIALIZED_NEXT_DUE = """
+        if next_due_{i} == day:
+            next_due_{i} = next_due_{i} + freq_{i}
+"""
+_SPECIALIZED_FOOTER = """
+    return waste, day + 1
+
+
+@njit(parallel=True, cache=True)
+def simulate_batch(doses, freqs, num_vials, vial_volume, waste_cap):
+    total_trials = doses.shape[0]
+    waste = np.empty(total_trials)
+    days = np.empty(total_trials, dtype=np.int32)
+    for p in prange(total_trials):
+        waste[p], days[p] = simulate(doses[p], freqs[p], num_vials,
+                                     vial_volume, waste_cap)
+    return waste, days
+"""
+
+
+# Where _specialized_module() writes the modules it generates.
+GENERATED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "__pycache__")
+
+
+@lru_cache(maxsize=None)
+def _specialized_module(total_people):
+    """Generates and imports the module behind make_simulate() and
+    make_simulate_batch() for a fixed number of people.
+
+    The source is written to a module in GENERATED_DIR and imported from
+    there, so Numba can cache the compiled code on disk. The file is only
+    rewritten when the source changes, since that invalidates the cache.
+    """
+    def names(prefix):
+        return ", ".join("{}_{}".format(prefix, i)
+                         for i in range(total_people)) + ","
+
+    def unrolled(template):
+        return "".join(template.format(i=i) for i in range(total_people))
+
+    earliest_due = ("min({})".format(names("next_due"))
+                    if total_people > 1 else "next_due_0")
+    source = (_SPECIALIZED_HEADER.format(
+                  total_people=total_people, unpack_doses=names("dose"),
+                  unpack_freqs=names("freq"),
+                  unpack_next_due=names("next_due"), last=total_people - 1,
+                  earliest_due=earliest_due)
+              + unrolled(_SPECIALIZED_DUE) + _SPECIALIZED_PASS
+              + unrolled(_SPECIALIZED_INJECTION) + _SPECIALIZED_NEW_VIAL
+              + unrolled(_SPECIALIZED_NEXT_DUE) + _SPECIALIZED_FOOTER)
+
+    module_name = "simulate_{}".format(total_people)
+    path = os.path.join(GENERATED_DIR, module_name + ".py")
+    try:
+        with open(path) as f:
+            unchanged = f.read() == source
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        os.makedirs(GENERATED_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(source)
+
+    # Numba looks the module up by name when it loads the cached code.
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    module.njit = njit
+    module.prange = prange
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_simulate(total_people):
+    """Generates a version of simulate() for a fixed number of people.
+
+    The loops over people are unrolled and every person's dosage, frequency
+    and next injection day is kept in its own local variable, so there is no
+    array indexing left in the simulation. The generated function is
+    compiled with Numba when it is available, and cached on disk.
+
+    Input Arguments:
+    total_people (int): The number of people doing injections.
+
+    Returns a function with the same arguments and results as simulate(). It
+    is compiled for the types it is first called with, so the batch version
+    can pass int32 frequencies as they are.
+    """
+    return _specialized_module(total_people).simulate
+
+
+@lru_cache(maxsize=65536)
+def simulate_cached(doses, freqs, num_vials, vial_volume):
+    """Runs the simulation for a trial, without a waste cap, remembering the
+    outcome.
+
+    Different permutations often end up with the same dosages and frequencies,
+    for example when they belong to different people, so repeats are looked
+    up instead of simulated again. Only the most recent outcomes are kept.
+    See simulate_cached.cache_info() for the hit rate.
+
+    Input Arguments:
+    doses (tuple of floats): Each person's dosage, sorted from largest to
+    smallest and rounded to 2 decimals.
+    freqs (tuple of ints): The matching interval (days) between injections.
+    num_vials (int): The number of medication vials to simulate.
+    vial_volume (float): The volume of each medication vial.
+
+    Returns the result of simulate().
+    """
+    return simulate(np.array(doses, dtype=np.float64),
+                    np.array(freqs, dtype=np.int64), num_vials, vial_volume,
+                    np.inf)
+
+
+def make_simulate_batch(total_people):
+    """Generates a parallel batch simulation for a fixed number of people.
+
+    Each trial is run by the function from make_simulate(total_people), and
+    the trials are shared out between Numba's threads. Set NUMBA_NUM_THREADS
+    to control how many threads are used. Like make_simulate(), it is cached
+    on disk, so it is only compiled the first time it is used. This is only
+    worthwhile when Numba is available.
+
+    Input Arguments:
+    total_people (int): The number of people doing injections.
+
+    Returns a function taking the same arguments as simulate() but with 2D
+    doses and freqs, one row per trial, and returning arrays of the waste and
+    days of every trial.
+    """
+    return _specialized_module(total_people).simulate_batch
+
+
+def simulate_batch(doses, freqs, num_vials=20, vial_volume=5.0,
+                   waste_cap=np.inf):
+    """Runs the simulation for many trials at once.
+
+    With Numba, the trials are compiled and run in parallel threads by
+    make_simulate_batch(). Without it, the Cython version is used if it has
+    been built, running the trials one after another as compiled C.
+    Otherwise they are run in lockstep with NumPy by simulate_batch_numpy().
+    They all take the same arguments and return the same results; run
+    check_simulators.py to check.
+    """
+    if NUMBA_AVAILABLE:
+        return make_simulate_batch(doses.shape[1])(
+            np.ascontiguousarray(doses, dtype=np.float64),
+            np.ascontiguousarray(freqs, dtype=np.int32), num_vials,
+            vial_volume, waste_cap)
+    if simulate_batch_cython is not None:
+        return simulate_batch_cython(doses, freqs, num_vials=num_vials,
+                                     vial_volume=vial_volume,
+                                     waste_cap=waste_cap)
+    return simulate_batch_numpy(doses, freqs, num_vials=num_vials,
+                                vial_volume=vial_volume, waste_cap=waste_cap)
+
+
+def simulate_batch_numpy(doses, freqs, num_vials=20, vial_volume=5.0,
+                         waste_cap=np.inf):
+    """Runs the simulation for many trials at once with NumPy.
+
+    Every trial is advanced in lockstep, one day at a time. The branches of
+    simulate() are replaced by boolean masks across the trial axis, so each
+    simulated day costs a handful of array operations regardless of how many
+    trials there are. The results match simulate() exactly.
+
+    Input Arguments:
+    doses (2D array of floats): One row per trial with each person's dosage,
+    sorted from largest to smallest.
+    freqs (2D array of ints): The matching interval (days) between injections.
+    int32 is enough and keeps the array small.
+    num_vials (int): The number of medication vials to simulate per trial.
+    vial_volume (float): The volume of each medication vial.
+    waste_cap (float): Stop a trial early once it has wasted more than this
+    much medication.
+
+    Every trial must have legal dosages (see check_legal_dosages), otherwise
+    the simulation never finishes.
+
+    Returns:
+    waste (array of floats): The amount of wasted medication per trial. If it
+    is more than waste_cap, the trial was stopped early.
+    day (array of ints): How many days each trial took to use the allocated
+    number of vials.
+    """
+    total_trials, total_people = doses.shape
+    min_dose = doses[:, -1]
+    max_dose = doses[:, 0]
+
+    # Keep each person's dosages contiguous, since they are used a column at
+    # a time.
+    doses_by_person = np.ascontiguousarray(doses.T)
+
+    # Initialize simulation status variables, one entry per trial. Counts fit
+    # comfortably in 32 bits, but volumes stay in float64: float32 rounding
+    # changes whether a dose still fits in a vial, and with it the outcome.
+    left_in_vial = np.full(total_trials, vial_volume, dtype=np.float64)
+    leftover_amount = np.zeros(total_trials)
+    leftover_vial = np.zeros(total_trials, dtype=bool)
+    vials_used = np.zeros(total_trials, dtype=np.int32)
+    waste = np.zeros(total_trials)
+    days = np.ones(total_trials, dtype=np.int32)
+
+    day = 1
+    running = (vials_used < num_vials) & (waste <= waste_cap)
+    while running.any():
+        # Anyone who isn't due for an injection today is already handled.
+        injections_handled = (day % freqs != 0) | ~running[:, None]
+        pending = running.copy()
+        while pending.any():
+            # Every update below is applied in place to the trials selected
+            # by a mask, so there are no per-trial branches and no temporary
+            # copies of the state. Comparing a >= b gives the same answer as
+            # a - b >= 0 for floats, without computing the difference.
+            for i in range(total_people):
+                dose = doses_by_person[i]
+                todo = pending & ~injections_handled[:, i]
+
+                # Check the leftover vial first if there is one.
+                from_leftover = (todo & leftover_vial
+                                 & (leftover_amount >= dose))
+                np.subtract(leftover_amount, dose, out=leftover_amount,
+                            where=from_leftover)
+                emptied = from_leftover & (leftover_amount < min_dose)
+                np.add(waste, leftover_amount, out=waste, where=emptied)
+                leftover_vial &= ~emptied
+
+                from_vial = todo & ~from_leftover & (left_in_vial >= dose)
+                np.subtract(left_in_vial, dose, out=left_in_vial,
+                            where=from_vial)
+                injections_handled[:, i] |= from_leftover | from_vial
+
+            # Discard vial if there isn't enough for anyone, or keep it as the
+            # leftover vial if there is enough for some but not all people.
+            discard = pending & (left_in_vial < min_dose)
+            np.add(waste, left_in_vial, out=waste, where=discard)
+            keep = pending & ~discard & (left_in_vial < max_dose)
+            leftover_vial |= keep
+            np.copyto(leftover_amount, left_in_vial, where=keep)
+            new_vial = discard | keep
+            vials_used += new_vial
+            np.copyto(left_in_vial, vial_volume, where=new_vial)
+
+            pending &= ~injections_handled.all(axis=1)
+        day = day + 1
+        days[running] = day
+        running = (vials_used < num_vials) & (waste <= waste_cap)
+
+    return waste, days